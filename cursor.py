@@ -14,6 +14,15 @@ class Cursor:
         self.groups: Dict[int, Tuple[int, int]] = {}  # Maps group numbers to (start, end) indices
         self.previous_match_index: Optional[int] = None
     
+    def reset(self, string: str) -> None:
+        """Points the cursor at a new string, so one cursor can be reused across matches"""
+        self.string = string
+        self.start_index = 0
+        self.end_index = len(string)
+        self.index = 0
+        self.groups.clear()
+        self.previous_match_index = None
+
     # Cursor starts moving
     def start_at(self, index: int) -> None:
         """Resets the cursor to the given index and clears captured groups"""
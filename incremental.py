@@ -0,0 +1,168 @@
+"""
+Incremental matching over a text buffer that changes by small edits.
+
+The matcher scans the buffer once, saving the set of active states at regular
+offsets (checkpoints) and recording every offset where the accepting state is
+active, i.e. where a match ends. After an edit it restarts from the last
+checkpoint before the change and stops as soon as its state set is the same as
+the old run's at the same (shifted) position: from there on the old run is
+still valid, so its checkpoints and match ends are reused.
+
+Match ends are stored relative to the checkpoint before them, so reusing the old
+run only shifts the checkpoint offsets, not every match end. The buffer itself
+belongs to the caller, who passes it in after each edit.
+"""
+from bisect import bisect_left, bisect_right
+from typing import *
+
+from program import Program, StateSet
+
+DEFAULT_INTERVAL = 4096
+
+
+class IncrementalMatcher:
+    """
+    Keeps the match ends of a Program over a buffer up to date as it's edited.
+    When 'anchored' is False a new match can start at every offset.
+
+    checkpoint_ends[i] holds the match ends from checkpoint i up to the next
+    one, as offsets from checkpoint_offsets[i].
+    """
+    def __init__(self, program: Program, text: str = "", interval: int = DEFAULT_INTERVAL, anchored: bool = False):
+        if interval < 1:
+            raise ValueError(f"Checkpoint interval must be positive, got {interval}")
+        self.program = program
+        self.interval = interval
+        self.anchored = anchored
+        self.text = ""
+        self.checkpoint_offsets: List[int] = []
+        self.checkpoint_states: List[StateSet] = []
+        self.checkpoint_ends: List[List[int]] = []
+        self._rescan(text, 0, 0, 0)
+
+    def edit(self, text: str, start: int, old_end: int, new_end: int) -> Tuple[int, int]:
+        """
+        Updates the match ends after an edit. 'text' is the whole buffer after
+        the edit, which replaced the old text[start:old_end] with text[start:new_end].
+        Returns the (start, end) range of the new text that was rescanned; match
+        ends outside of it are unchanged apart from being shifted by the edit.
+        """
+        if not (0 <= start <= old_end <= len(self.text) and start <= new_end <= len(text)):
+            raise IndexError(f"Edit {start}:{old_end} -> {start}:{new_end} is outside of the buffer")
+        delta = new_end - old_end
+        if len(text) != len(self.text) + delta:
+            raise ValueError(f"Buffer length {len(text)} doesn't match the edit (expected {len(self.text) + delta})")
+
+        # Closures are evaluated with the cursor at the checkpoint, so one that
+        # sits right at 'start' may have seen the old character there
+        restart = max(bisect_left(self.checkpoint_offsets, start) - 1, 0)
+        return self._rescan(text, restart, new_end, delta)
+
+    def extend(self, text: str) -> Tuple[int, int]:
+        """Updates the match ends after the buffer grew at the end; 'text' is the whole new buffer"""
+        end = len(self.text)
+        return self.edit(text, end, end, len(text))
+
+    @property
+    def match_ends(self) -> List[int]:
+        """Returns every match end, in order"""
+        return [
+            base + end
+            for base, ends in zip(self.checkpoint_offsets, self.checkpoint_ends)
+            for end in ends
+        ]
+
+    def ends_between(self, start: int, end: int) -> List[int]:
+        """Returns the match ends in [start, end)"""
+        found = []
+        first = max(bisect_right(self.checkpoint_offsets, start) - 1, 0)
+        last = bisect_left(self.checkpoint_offsets, end)
+        for i in range(first, last):
+            base = self.checkpoint_offsets[i]
+            found.extend(base + e for e in self.checkpoint_ends[i] if start <= base + e < end)
+        return found
+
+    # Scanning
+
+    def _rescan(self, text: str, restart: int, edit_end: int, delta: int) -> Tuple[int, int]:
+        """
+        Scans 'text' from checkpoint 'restart' until the state set converges with
+        the old run past 'edit_end', or until the end of the text. Nothing is
+        changed if the scan raises.
+        'delta' is how far the edit moved the text after it.
+        """
+        program = self.program
+        scratch = program.scratch()
+        restart_matches = not self.anchored
+        accept = program.accept
+        text_length = len(text)
+        scratch.cursor.reset(text)
+
+        if restart > 0:
+            offset = self.checkpoint_offsets[restart]
+            current = self.checkpoint_states[restart]
+        else:
+            offset = 0
+            current = program.initial(scratch, 0)
+
+        old_offsets = self.checkpoint_offsets
+        old_states = self.checkpoint_states
+        half = (self.interval + 1) // 2
+        # After the edit, checkpoints go where the old run had them (shifted),
+        # so the two runs can be joined there. The first one is skipped while it
+        # would leave less than half an interval after 'offset'.
+        j = bisect_right(old_offsets, edit_end - delta, restart + 1)
+        while j < len(old_offsets) and old_offsets[j] + delta - offset < half:
+            j += 1
+        target = old_offsets[j] + delta if j < len(old_offsets) else None
+        # Up to there, a checkpoint goes every interval, unless it would leave
+        # less than half an interval before the limit
+        limit = text_length if target is None else target
+
+        offsets: List[int] = []
+        states: List[StateSet] = []
+        checkpoint_ends: List[List[int]] = []
+        ends: List[int] = []
+        base = offset
+        next_checkpoint = offset
+        position = offset
+        while True:
+            is_checkpoint = False
+            if position < limit:
+                if position == next_checkpoint:
+                    is_checkpoint = position == offset or limit - position >= half
+                    next_checkpoint = position + self.interval
+            elif position == target:
+                is_checkpoint = True
+                j += 1
+                target = old_offsets[j] + delta if j < len(old_offsets) else None
+            if is_checkpoint:
+                base = position
+                ends = []
+                offsets.append(position)
+                states.append(current)
+                checkpoint_ends.append(ends)
+            if accept in current:
+                ends.append(position - base)
+            if position == text_length:
+                break
+
+            current = program.step(scratch, current, position, restart_matches)
+            position += 1
+
+            if position == target and old_states[j] == current:
+                # The old run from checkpoint j on is still valid; only its
+                # offsets move
+                offsets.extend([o + delta for o in old_offsets[j:]] if delta else old_offsets[j:])
+                states.extend(old_states[j:])
+                checkpoint_ends.extend(self.checkpoint_ends[j:])
+                break
+
+        self.text = text
+        self.checkpoint_offsets[restart:] = offsets
+        self.checkpoint_states[restart:] = states
+        self.checkpoint_ends[restart:] = checkpoint_ends
+        return offset, position
+
+    def __repr__(self) -> str:
+        return f"<IncrementalMatcher length={len(self.text)} checkpoints={len(self.checkpoint_offsets)}>"
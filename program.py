@@ -0,0 +1,189 @@
+"""
+A compiled program is an immutable, flattened copy of a state graph. It can be
+shared between threads as is; everything that changes during a match lives in a
+Scratch, and each thread gets its own.
+"""
+import threading
+from typing import *
+
+from cursor import Cursor
+from state import State, Condition, collect_states, is_character_condition
+
+if TYPE_CHECKING:
+    from serialization import SerializedPattern
+
+# The DFA cache is dropped once it holds this many entries
+MAX_CACHE_SIZE = 10000
+
+# A set of active states, as sorted state indices
+StateSet = Tuple[int, ...]
+
+
+class Scratch:
+    """
+    Mutable per-thread state for running a Program: the cursor (which also holds
+    the capture groups), the marks used to build state sets, and the DFA cache
+    """
+    def __init__(self, program: 'Program'):
+        self.cursor: Cursor = Cursor("")
+        self.marks: List[int] = [0] * len(program.transitions)
+        self.generation: int = 0
+        self.stack: List[int] = []
+        self.cache: Dict[Tuple[StateSet, str, bool], StateSet] = {}
+
+    def next_generation(self) -> int:
+        """Starts a new state set; a state is in it when its mark equals the generation"""
+        self.generation += 1
+        return self.generation
+
+
+class Program:
+    """
+    Immutable program compiled from a state graph.
+    transitions[i] holds the (end index, condition) pairs of state i, and
+    'start' and 'accept' are indices into it.
+    """
+    def __init__(self, start: State, accept: Optional[State] = None):
+        states = collect_states(start)
+        index_of = {state: i for i, state in enumerate(states)}
+
+        if accept is not None and accept not in index_of:
+            raise ValueError("Accepting state isn't reachable from the start state")
+
+        transitions = tuple(
+            tuple((index_of[t.end], t.condition) for t in state.transition)
+            for state in states
+        )
+        self._setup(transitions, 0, index_of[accept] if accept is not None else None)
+
+    @classmethod
+    def from_tables(cls, transitions: Tuple[Tuple[Tuple[int, Condition], ...], ...], start: int, accept: Optional[int]) -> 'Program':
+        """Creates a program straight from a transition table, without a state graph"""
+        program = cls.__new__(cls)
+        program._setup(transitions, start, accept)
+        return program
+
+    @classmethod
+    def from_serialized(cls, pattern: 'SerializedPattern') -> 'Program':
+        return cls.from_tables(pattern.transitions, pattern.start, pattern.accept)
+
+    def _setup(self, transitions: Tuple[Tuple[Tuple[int, Condition], ...], ...], start: int, accept: Optional[int]) -> None:
+        self.transitions: Tuple[Tuple[Tuple[int, Condition], ...], ...] = transitions
+        self.start: int = start
+        self.accept: Optional[int] = accept
+        # Next state sets only depend on the character when every condition does
+        self.is_cacheable: bool = all(
+            is_character_condition(condition)
+            for row in self.transitions
+            for _, condition in row
+        )
+        self._local = threading.local()
+
+    def scratch(self) -> Scratch:
+        """Returns the calling thread's scratch, creating it on first use"""
+        scratch = getattr(self._local, "scratch", None)
+        if scratch is None:
+            scratch = Scratch(self)
+            self._local.scratch = scratch
+        return scratch
+
+    # Simulation
+
+    def _closure(self, scratch: Scratch, seeds: Iterable[int], index: int) -> StateSet:
+        """Returns the seeds plus every state reachable from them through epsilon transitions at 'index'"""
+        cursor = scratch.cursor
+        cursor.advance_to(index)
+        marks = scratch.marks
+        generation = scratch.next_generation()
+        stack = scratch.stack
+        found = []
+
+        for seed in seeds:
+            if marks[seed] != generation:
+                marks[seed] = generation
+                stack.append(seed)
+        while stack:
+            state = stack.pop()
+            found.append(state)
+            for end, condition in self.transitions[state]:
+                if marks[end] == generation:
+                    continue
+                result = condition.can_perform_transition(cursor)
+                if result.accepted and result.count == 0:
+                    marks[end] = generation
+                    stack.append(end)
+
+        found.sort()
+        return tuple(found)
+
+    def initial(self, scratch: Scratch, index: int = 0) -> StateSet:
+        """Returns the active states before consuming the character at 'index'"""
+        return self._closure(scratch, (self.start,), index)
+
+    def step(self, scratch: Scratch, current: StateSet, index: int, restart: bool = False) -> StateSet:
+        """
+        Consumes the character at 'index' and returns the active states after it.
+        With 'restart' the start state is added after the character too, so a
+        new match can begin there.
+        """
+        if not current and not restart:
+            return current
+
+        cursor = scratch.cursor
+        if self.is_cacheable:
+            key = (current, cursor.string[index], restart)
+            cached = scratch.cache.get(key)
+            if cached is not None:
+                return cached
+
+        cursor.advance_to(index)
+        seeds = []
+        for state in current:
+            for end, condition in self.transitions[state]:
+                result = condition.can_perform_transition(cursor)
+                if not result.accepted or result.count == 0:
+                    continue
+                if result.count != 1:
+                    raise ValueError(f"Program only supports conditions consuming one character: {condition!r}")
+                seeds.append(end)
+        if restart:
+            seeds.append(self.start)
+        following = self._closure(scratch, seeds, index + 1)
+
+        if self.is_cacheable:
+            if len(scratch.cache) >= MAX_CACHE_SIZE:
+                scratch.cache.clear()
+            scratch.cache[key] = following
+        return following
+
+    def is_accepting(self, current: StateSet) -> bool:
+        return self.accept is not None and self.accept in current
+
+    # Matching
+
+    def match(self, string: str, start: int = 0) -> Optional[int]:
+        """
+        Runs the program from 'start' and returns the end index of the longest
+        match, or None if the accepting state is never reached
+        """
+        scratch = self.scratch()
+        cursor = scratch.cursor
+        cursor.reset(string)
+        cursor.start_at(start)
+
+        current = self.initial(scratch, start)
+        end = start if self.is_accepting(current) else None
+        for index in range(start, len(string)):
+            current = self.step(scratch, current, index)
+            if not current:
+                break
+            if self.is_accepting(current):
+                end = index + 1
+        return end
+
+    def full_match(self, string: str) -> bool:
+        """Returns True if the whole string takes the program to the accepting state"""
+        return self.match(string) == len(string)
+
+    def __repr__(self) -> str:
+        return f"<Program states={len(self.transitions)} accept={self.accept}>"
@@ -0,0 +1,499 @@
+"""
+Binary format for compiled patterns, so a worker can skip parsing and building
+the state graph at startup.
+
+Layout (little endian):
+    header       magic, version, flags, state count, transition count,
+                 start state, accept state, size of the AST section
+    states       one (first transition, transition count) record per state
+    transitions  one (end state, condition kind, argument) record per transition
+    ast          optional, tagged preorder encoding of the AST
+
+MatchSet nodes hold an arbitrary Python object, so an AST containing one can't
+be serialized.
+
+Every record in the state and transition tables has a fixed width, so loading
+them is a single struct.iter_unpack pass over the buffer, straight into the
+tables Program runs on.
+
+Many patterns go into one library file:
+    header       magic, version, pattern count
+    entries      one (offset, size) record per pattern
+    patterns     the buffers written by dumps(), one after another
+
+open_library() maps the file read only and keeps it mapped. Opening it only
+reads the header; each pattern is decoded the first time it's used. Open the
+library before forking and the children share the mapped pages, each decoding
+only the patterns it uses.
+"""
+import mmap
+import os
+import struct
+import sys
+from typing import *
+
+import ASM
+from state import State, Transition, Condition, Epsilon, MatchChar, AnyCharacter, collect_states, is_character_condition
+
+MAGIC = b"RXSM"
+VERSION = 1
+
+FLAG_HAS_AST = 0x1
+NO_STATE = 0xFFFFFFFF
+INT32_MAX = 2 ** 31 - 1
+
+LIBRARY_MAGIC = b"RXLB"
+
+HEADER = struct.Struct("<4sHHIIIII")
+LIBRARY_HEADER = struct.Struct("<4sHxxI")
+LIBRARY_ENTRY = struct.Struct("<QQ")
+STATE_RECORD = struct.Struct("<II")
+TRANSITION_RECORD = struct.Struct("<IBI")
+
+# Condition kinds
+EPSILON = 0
+MATCH_CHAR = 1
+ANY_CHARACTER = 2
+
+# AST node tags
+TAG_ANY_CHARACTER = 0
+TAG_MATCH_CHARACTER = 1
+TAG_MATCH_STRING = 2
+TAG_GROUP = 3
+TAG_IMPLICIT_GROUP = 4
+TAG_ALTERNATION = 5
+TAG_BACKREFERENCE = 6
+TAG_ANCHOR = 7
+TAG_CHARACTER_GROUP = 8
+TAG_QUANTIFIED_EXPRESSION = 9
+
+TAG_ITEM_CHARACTER = 0
+TAG_ITEM_RANGE = 1
+
+QUANTIFIER_TYPES: List[ASM.QuantifierType] = list(ASM.QuantifierType)
+ANCHORS: List[ASM.Anchor] = list(ASM.Anchor)
+
+
+class SerializationError(ValueError):
+    """Raised when a pattern can't be written or a buffer can't be read"""
+    pass
+
+
+class SerializedPattern:
+    """
+    A pattern restored from its binary form: the AST (if it was stored) and the
+    transition table. transitions[i] holds the (end index, condition) pairs of
+    state i, the same layout Program runs on, so no State objects are built
+    unless build_states() is called.
+    """
+    def __init__(self, ast: Optional[ASM.AST], transitions: Tuple[Tuple[Tuple[int, Condition], ...], ...], start: int, accept: Optional[int]):
+        self.ast = ast
+        self.transitions = transitions
+        self.start = start
+        self.accept = accept
+
+    def build_states(self) -> List[State]:
+        """Builds the state graph; states are in the same order as the transition table"""
+        states = [State() for _ in self.transitions]
+        for state, transitions in zip(states, self.transitions):
+            state.transition.extend(Transition(states[end], condition) for end, condition in transitions)
+        return states
+
+    def __repr__(self) -> str:
+        return f"<SerializedPattern states={len(self.transitions)} has_ast={self.ast is not None}>"
+
+
+# State graph
+
+def _encode_condition(condition: Condition) -> Tuple[int, int]:
+    """Returns the (kind, argument) pair for a condition"""
+    if not is_character_condition(condition):
+        if type(condition) is Epsilon:
+            raise SerializationError(f"Can't serialize an epsilon with a predicate: {condition!r}")
+        raise SerializationError(f"Unsupported condition: {condition!r}")
+    if type(condition) is Epsilon:
+        return EPSILON, 0
+    if type(condition) is MatchChar:
+        if len(condition.char) != 1:
+            raise SerializationError(f"MatchChar must hold a single character: {condition!r}")
+        return MATCH_CHAR, ord(condition.char)
+    return ANY_CHARACTER, int(condition.including_newline)
+
+
+def _decode_condition(kind: int, argument: int) -> Condition:
+    if kind == EPSILON:
+        return Epsilon()
+    if kind == MATCH_CHAR:
+        if argument > sys.maxunicode:
+            raise SerializationError(f"Invalid character code: {argument}")
+        return MatchChar(chr(argument))
+    if kind == ANY_CHARACTER:
+        return AnyCharacter(including_newline=bool(argument))
+    raise SerializationError(f"Unknown condition kind: {kind}")
+
+
+# AST
+
+def _write_string(out: bytearray, string: str) -> None:
+    data = string.encode("utf-8")
+    out += struct.pack("<I", len(data))
+    out += data
+
+
+def _write_index(out: bytearray, index: int) -> None:
+    if not 0 <= index <= INT32_MAX:
+        raise SerializationError(f"Index {index} doesn't fit in 31 bits")
+    out += struct.pack("<i", index)
+
+
+def _write_units(out: bytearray, units: List[ASM.Unit]) -> None:
+    out += struct.pack("<I", len(units))
+    for unit in units:
+        _write_unit(out, unit)
+
+
+def _write_unit(out: bytearray, unit: Any) -> None:
+    if isinstance(unit, ASM.AnyCharacter):
+        out.append(TAG_ANY_CHARACTER)
+    elif isinstance(unit, ASM.MatchCharacter):
+        out.append(TAG_MATCH_CHARACTER)
+        _write_string(out, unit.character)
+    elif isinstance(unit, ASM.MatchString):
+        out.append(TAG_MATCH_STRING)
+        _write_string(out, unit.string)
+    elif isinstance(unit, ASM.Group):
+        out.append(TAG_GROUP)
+        if unit.index is None:
+            out += struct.pack("<i", -1)
+        else:
+            _write_index(out, unit.index)
+        out.append(int(unit.is_capturing))
+        _write_units(out, unit.children)
+    elif isinstance(unit, ASM.ImplicitGroup):
+        out.append(TAG_IMPLICIT_GROUP)
+        _write_units(out, unit.children)
+    elif isinstance(unit, ASM.Alternation):
+        out.append(TAG_ALTERNATION)
+        _write_units(out, unit.children)
+    elif isinstance(unit, ASM.Backreference):
+        out.append(TAG_BACKREFERENCE)
+        _write_index(out, unit.index)
+    elif isinstance(unit, ASM.Anchor):
+        out.append(TAG_ANCHOR)
+        out.append(ANCHORS.index(unit))
+    elif isinstance(unit, ASM.CharacterGroup):
+        out.append(TAG_CHARACTER_GROUP)
+        out += struct.pack("<BI", unit.is_inverted, len(unit.items))
+        for item in unit.items:
+            if isinstance(item, ASM.GroupItemCharacter):
+                out.append(TAG_ITEM_CHARACTER)
+                _write_string(out, item.character)
+            elif isinstance(item, ASM.GroupItemRange):
+                out.append(TAG_ITEM_RANGE)
+                _write_string(out, item.start)
+                _write_string(out, item.end)
+            else:
+                raise SerializationError(f"Unsupported character group item: {item!r}")
+    elif isinstance(unit, ASM.QuantifiedExpression):
+        out.append(TAG_QUANTIFIED_EXPRESSION)
+        out += struct.pack("<BB", QUANTIFIER_TYPES.index(unit.quantifier.qtype), unit.quantifier.is_lazy)
+        _write_unit(out, unit.expression)
+    else:
+        raise SerializationError(f"Unsupported AST unit: {unit!r}")
+
+
+class _Reader:
+    """Reads values out of buffer[offset:end], moving the offset forward as it goes"""
+    def __init__(self, buffer: memoryview, offset: int, end: int):
+        self.buffer = buffer
+        self.offset = offset
+        self.end = end
+
+    def unpack(self, fmt: str) -> Tuple[Any, ...]:
+        size = struct.calcsize(fmt)
+        if self.offset + size > self.end:
+            raise SerializationError("AST section is truncated")
+        values = struct.unpack_from(fmt, self.buffer, self.offset)
+        self.offset += size
+        return values
+
+    def byte(self) -> int:
+        return self.unpack("<B")[0]
+
+    def string(self) -> str:
+        (length,) = self.unpack("<I")
+        if self.offset + length > self.end:
+            raise SerializationError("AST section is truncated")
+        data = bytes(self.buffer[self.offset:self.offset + length])
+        self.offset += length
+        try:
+            return data.decode("utf-8")
+        except UnicodeDecodeError as e:
+            raise SerializationError(f"Invalid string in AST section: {e}") from None
+
+    def choice(self, values: List[Any], what: str) -> Any:
+        """Reads a byte and returns the value it indexes"""
+        index = self.byte()
+        if index >= len(values):
+            raise SerializationError(f"Unknown {what}: {index}")
+        return values[index]
+
+    def units(self) -> List[ASM.Unit]:
+        (count,) = self.unpack("<I")
+        return [self.unit() for _ in range(count)]
+
+    def unit(self) -> Any:
+        tag = self.byte()
+        if tag == TAG_ANY_CHARACTER:
+            return ASM.AnyCharacter()
+        if tag == TAG_MATCH_CHARACTER:
+            return ASM.MatchCharacter(self.string())
+        if tag == TAG_MATCH_STRING:
+            return ASM.MatchString(self.string())
+        if tag == TAG_GROUP:
+            index, is_capturing = self.unpack("<iB")
+            return ASM.Group(self.units(), index=None if index < 0 else index, is_capturing=bool(is_capturing))
+        if tag == TAG_IMPLICIT_GROUP:
+            return ASM.ImplicitGroup(self.units())
+        if tag == TAG_ALTERNATION:
+            return ASM.Alternation(self.units())
+        if tag == TAG_BACKREFERENCE:
+            return ASM.Backreference(self.unpack("<i")[0])
+        if tag == TAG_ANCHOR:
+            return self.choice(ANCHORS, "anchor")
+        if tag == TAG_CHARACTER_GROUP:
+            is_inverted, count = self.unpack("<BI")
+            items: List[ASM.CharacterGroupItem] = []
+            for _ in range(count):
+                item_tag = self.byte()
+                if item_tag == TAG_ITEM_CHARACTER:
+                    items.append(ASM.GroupItemCharacter(self.string()))
+                elif item_tag == TAG_ITEM_RANGE:
+                    items.append(ASM.GroupItemRange(self.string(), self.string()))
+                else:
+                    raise SerializationError(f"Unknown character group item tag: {item_tag}")
+            return ASM.CharacterGroup(bool(is_inverted), items)
+        if tag == TAG_QUANTIFIED_EXPRESSION:
+            qtype = self.choice(QUANTIFIER_TYPES, "quantifier type")
+            quantifier = ASM.Quantifier(qtype, is_lazy=bool(self.byte()))
+            return ASM.QuantifiedExpression(self.unit(), quantifier)
+        raise SerializationError(f"Unknown AST tag: {tag}")
+
+
+# Public API
+
+def dumps(start: State, accept: Optional[State] = None, ast: Optional[ASM.AST] = None) -> bytes:
+    """
+    Serializes the state graph reachable from 'start', and optionally its AST.
+    'accept' marks the accepting state, if the graph has one.
+    """
+    states = collect_states(start)
+    index_of = {state: i for i, state in enumerate(states)}
+
+    if accept is not None and accept not in index_of:
+        raise SerializationError("Accepting state isn't reachable from the start state")
+
+    state_table = bytearray()
+    transition_table = bytearray()
+    transition_count = 0
+    for state in states:
+        state_table += STATE_RECORD.pack(transition_count, len(state.transition))
+        for transition in state.transition:
+            kind, argument = _encode_condition(transition.condition)
+            transition_table += TRANSITION_RECORD.pack(index_of[transition.end], kind, argument)
+        transition_count += len(state.transition)
+
+    ast_section = bytearray()
+    flags = 0
+    if ast is not None:
+        flags |= FLAG_HAS_AST
+        ast_section.append(int(ast.is_from_start_of_string))
+        try:
+            _write_unit(ast_section, ast.root)
+        except RecursionError:
+            raise SerializationError("AST is nested too deeply") from None
+
+    header = HEADER.pack(
+        MAGIC, VERSION, flags,
+        len(states), transition_count,
+        0, NO_STATE if accept is None else index_of[accept],
+        len(ast_section),
+    )
+    return bytes(header + state_table + transition_table + ast_section)
+
+
+def loads(buffer: Union[bytes, bytearray, memoryview, mmap.mmap]) -> SerializedPattern:
+    """
+    Restores a pattern from a buffer written by dumps().
+    Raises SerializationError if the buffer is corrupt or from another version.
+    """
+    # Every slice of 'view' is dropped before the with block exits, so an mmap
+    # passed in can be closed even when decoding fails
+    with memoryview(buffer) as view:
+        return _decode(view)
+
+
+def _decode(view: memoryview) -> SerializedPattern:
+    if len(view) < HEADER.size:
+        raise SerializationError("Buffer is too small to hold a pattern")
+
+    magic, version, flags, state_count, transition_count, start, accept, ast_size = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise SerializationError(f"Bad magic: {magic!r}")
+    if version != VERSION:
+        raise SerializationError(f"Unsupported version: {version} (expected {VERSION})")
+    if start >= state_count:
+        raise SerializationError(f"Start state {start} is out of range ({state_count} states)")
+    if accept != NO_STATE and accept >= state_count:
+        raise SerializationError(f"Accepting state {accept} is out of range ({state_count} states)")
+
+    states_offset = HEADER.size
+    transitions_offset = states_offset + state_count * STATE_RECORD.size
+    ast_offset = transitions_offset + transition_count * TRANSITION_RECORD.size
+    if len(view) < ast_offset + ast_size:
+        raise SerializationError("Buffer is truncated")
+
+    state_records = list(STATE_RECORD.iter_unpack(view[states_offset:transitions_offset]))
+    records = list(TRANSITION_RECORD.iter_unpack(view[transitions_offset:ast_offset]))
+
+    # Conditions hold no state, so equal ones are shared
+    conditions: Dict[Tuple[int, int], Condition] = {}
+    transitions = []
+    expected_first = 0
+    for first, count in state_records:
+        if first != expected_first or first + count > transition_count:
+            raise SerializationError(f"State table doesn't match the {transition_count} transitions")
+        row = []
+        for end, kind, argument in records[first:first + count]:
+            if end >= state_count:
+                raise SerializationError(f"Transition to state {end} is out of range ({state_count} states)")
+            condition = conditions.get((kind, argument))
+            if condition is None:
+                condition = conditions[(kind, argument)] = _decode_condition(kind, argument)
+            row.append((end, condition))
+        transitions.append(tuple(row))
+        expected_first = first + count
+    if expected_first != transition_count:
+        raise SerializationError(f"State table doesn't match the {transition_count} transitions")
+
+    ast = None
+    if flags & FLAG_HAS_AST:
+        reader = _Reader(view, ast_offset, ast_offset + ast_size)
+        try:
+            is_from_start_of_string = bool(reader.byte())
+            ast = ASM.AST(is_from_start_of_string, reader.unit())
+        except RecursionError:
+            raise SerializationError("AST section is nested too deeply") from None
+        if reader.offset != reader.end:
+            raise SerializationError("AST section has trailing bytes")
+
+    return SerializedPattern(ast, tuple(transitions), start, None if accept == NO_STATE else accept)
+
+
+def dump(path: str, start: State, accept: Optional[State] = None, ast: Optional[ASM.AST] = None) -> None:
+    """Writes the serialized pattern to a file"""
+    with open(path, "wb") as f:
+        f.write(dumps(start, accept, ast))
+
+
+def load(path: str) -> SerializedPattern:
+    """
+    Maps the file read only and restores the pattern from it.
+    Raises SerializationError if the file is empty, corrupt or from another version.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise SerializationError(f"{path} is empty")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return loads(mapped)
+
+
+# Libraries
+
+class PatternLibrary:
+    """
+    Many serialized patterns in one buffer. library[i] decodes pattern i the
+    first time it's asked for and keeps the result.
+    """
+    def __init__(self, buffer: Union[bytes, bytearray, memoryview, mmap.mmap], owner: Optional[mmap.mmap] = None):
+        if len(buffer) < LIBRARY_HEADER.size:
+            raise SerializationError("Buffer is too small to hold a library")
+        magic, version, count = LIBRARY_HEADER.unpack_from(buffer, 0)
+        if magic != LIBRARY_MAGIC:
+            raise SerializationError(f"Bad magic: {magic!r}")
+        if version != VERSION:
+            raise SerializationError(f"Unsupported version: {version} (expected {VERSION})")
+        if len(buffer) < LIBRARY_HEADER.size + count * LIBRARY_ENTRY.size:
+            raise SerializationError("Library entry table is truncated")
+
+        self._patterns: List[Optional[SerializedPattern]] = [None] * count
+        self._owner = owner
+        self._view = memoryview(buffer)
+
+    def __len__(self) -> int:
+        return len(self._patterns)
+
+    def __getitem__(self, index: int) -> SerializedPattern:
+        pattern = self._patterns[index]
+        if pattern is None:
+            pattern = self._patterns[index] = self._decode_entry(index % len(self._patterns))
+        return pattern
+
+    def _decode_entry(self, index: int) -> SerializedPattern:
+        offset, size = LIBRARY_ENTRY.unpack_from(self._view, LIBRARY_HEADER.size + index * LIBRARY_ENTRY.size)
+        if offset + size > len(self._view):
+            raise SerializationError(f"Pattern {index} is outside of the library")
+        # Released on the way out, so a failed decode doesn't keep the mapping busy
+        with self._view[offset:offset + size] as view:
+            return _decode(view)
+
+    def close(self) -> None:
+        """Releases the buffer, and unmaps the file if the library was opened from one"""
+        self._view.release()
+        if self._owner is not None:
+            self._owner.close()
+
+    def __enter__(self) -> 'PatternLibrary':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        decoded = sum(pattern is not None for pattern in self._patterns)
+        return f"<PatternLibrary patterns={len(self._patterns)} decoded={decoded}>"
+
+
+def dumps_library(patterns: Sequence[bytes]) -> bytes:
+    """Packs buffers written by dumps() into one library"""
+    out = bytearray(LIBRARY_HEADER.pack(LIBRARY_MAGIC, VERSION, len(patterns)))
+    offset = LIBRARY_HEADER.size + len(patterns) * LIBRARY_ENTRY.size
+    for pattern in patterns:
+        out += LIBRARY_ENTRY.pack(offset, len(pattern))
+        offset += len(pattern)
+    for pattern in patterns:
+        out += pattern
+    return bytes(out)
+
+
+def dump_library(path: str, patterns: Sequence[bytes]) -> None:
+    """Writes a library of buffers written by dumps() to a file"""
+    with open(path, "wb") as f:
+        f.write(dumps_library(patterns))
+
+
+def open_library(path: str) -> PatternLibrary:
+    """
+    Maps the library file read only. The mapping stays open until the library
+    is closed. Raises SerializationError if the file is empty, corrupt or from
+    another version; a corrupt pattern raises when it's first used.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise SerializationError(f"{path} is empty")
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return PatternLibrary(mapped, owner=mapped)
+    except SerializationError:
+        mapped.close()
+        raise
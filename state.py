@@ -127,10 +127,31 @@ class AnyCharacter(Condition):
     def __repr__(self) -> str:
         return f"AnyCharacter(including_newline={self.including_newline})"
 
-    
-    
 
+def is_character_condition(condition: Condition) -> bool:
+    """
+    Returns True for the built in conditions whose result only depends on the
+    current character: MatchChar, AnyCharacter and an Epsilon without a predicate.
+    Subclasses don't count, as they may override can_perform_transition.
+    """
+    if type(condition) is Epsilon:
+        return condition.predicate is None
+    return type(condition) in (MatchChar, AnyCharacter)
 
-    
 
-        
\ No newline at end of file
+def collect_states(start: State) -> List[State]:
+    """
+    Returns every state reachable from 'start', in breadth first order.
+    The position of a state in this list is its index in a Program and in the
+    binary format.
+    """
+    states = [start]
+    seen = {start}
+    i = 0
+    while i < len(states):
+        for transition in states[i].transition:
+            if transition.end not in seen:
+                seen.add(transition.end)
+                states.append(transition.end)
+        i += 1
+    return states
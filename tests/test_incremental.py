@@ -0,0 +1,140 @@
+import random
+
+import pytest
+
+from incremental import IncrementalMatcher
+from program import Program
+from state import State, Transition, Condition, ConditionResult, MatchChar
+
+
+def ab_star_c():
+    """ab*c"""
+    start, b, accept = State(), State(), State()
+    start.transition.append(Transition(b, MatchChar("a")))
+    b.transition.append(Transition(b, MatchChar("b")))
+    b.transition.append(Transition(accept, MatchChar("c")))
+    return Program(start, accept)
+
+
+def word_starting_with_a():
+    """An 'a' at the start of the buffer or after a space"""
+    start, boundary, accept = State(), State(), State()
+    start.transition.append(Transition.epsilon(
+        boundary, lambda cursor: cursor.index == 0 or cursor.string[cursor.index - 1] == " "
+    ))
+    boundary.transition.append(Transition(accept, MatchChar("a")))
+    return Program(start, accept)
+
+
+def random_text(rng, length):
+    return "".join(rng.choice("abc ") for _ in range(length))
+
+
+@pytest.mark.parametrize("make_program", [ab_star_c, word_starting_with_a])
+@pytest.mark.parametrize("anchored", [False, True])
+def test_edits_agree_with_a_full_scan(make_program, anchored):
+    program = make_program()
+    rng = random.Random(0)
+    for _ in range(200):
+        text = random_text(rng, rng.randint(0, 60))
+        matcher = IncrementalMatcher(program, text, interval=rng.randint(1, 8), anchored=anchored)
+        for _ in range(10):
+            start = rng.randint(0, len(text))
+            old_end = rng.randint(start, len(text))
+            replacement = random_text(rng, rng.randint(0, 5))
+            text = text[:start] + replacement + text[old_end:]
+            matcher.edit(text, start, old_end, start + len(replacement))
+
+            fresh = IncrementalMatcher(program, text, interval=3, anchored=anchored)
+            assert matcher.match_ends == fresh.match_ends
+
+
+def test_extend_agrees_with_a_full_scan():
+    program = ab_star_c()
+    rng = random.Random(1)
+    text = ""
+    matcher = IncrementalMatcher(program, text, interval=4)
+    for _ in range(50):
+        text += random_text(rng, rng.randint(0, 6))
+        matcher.extend(text)
+        assert matcher.match_ends == IncrementalMatcher(program, text, interval=4).match_ends
+
+
+def test_ends_between():
+    text = "abc abbc ac " * 20
+    matcher = IncrementalMatcher(ab_star_c(), text, interval=5)
+    ends = matcher.match_ends
+    for start in range(0, len(text) + 1, 7):
+        for end in range(start, len(text) + 2, 11):
+            assert matcher.ends_between(start, end) == [e for e in ends if start <= e < end]
+
+
+def test_small_edit_rescans_near_the_edit_only():
+    interval = 64
+    text = "abbc " * 20000
+    matcher = IncrementalMatcher(ab_star_c(), text, interval=interval)
+
+    text = text[:50000] + "xx" + text[50001:]
+    rescanned_start, rescanned_end = matcher.edit(text, 50000, 50001, 50002)
+
+    assert 50000 - 2 * interval <= rescanned_start <= 50000
+    assert 50002 < rescanned_end <= 50002 + 2 * interval
+    assert matcher.match_ends == IncrementalMatcher(ab_star_c(), text, interval=interval).match_ends
+
+
+def test_edit_must_match_the_buffer_length():
+    matcher = IncrementalMatcher(ab_star_c(), "abc")
+    with pytest.raises(ValueError):
+        matcher.edit("abcd", 0, 1, 1)
+    with pytest.raises(IndexError):
+        matcher.edit("abc", 2, 4, 3)
+
+
+class TwoCharacters(Condition):
+    """Consumes two characters at an 'x', which Program doesn't support"""
+    def can_perform_transition(self, cursor):
+        if cursor.character == "x":
+            return ConditionResult.accepted_result(count=2)
+        return ConditionResult.rejected_result()
+
+
+def test_failed_edit_leaves_the_matcher_unchanged():
+    start, accept = State(), State()
+    start.transition.append(Transition(accept, MatchChar("a")))
+    start.transition.append(Transition(accept, TwoCharacters()))
+    matcher = IncrementalMatcher(Program(start, accept), "a b a", interval=2)
+    before = (matcher.text, matcher.checkpoint_offsets[:], matcher.match_ends)
+
+    with pytest.raises(ValueError):
+        matcher.edit("a x b a", 1, 1, 3)
+
+    assert (matcher.text, matcher.checkpoint_offsets, matcher.match_ends) == before
+    assert matcher.edit("a a b a", 1, 1, 3) is not None
+    assert matcher.match_ends == [1, 3, 7]
+
+
+def test_checkpoints_stay_about_an_interval_apart_over_many_edits():
+    interval = 32
+    half = interval // 2
+    program = ab_star_c()
+    rng = random.Random(2)
+    text = random_text(rng, 20000)
+    matcher = IncrementalMatcher(program, text, interval=interval)
+
+    def check():
+        offsets = matcher.checkpoint_offsets + [len(matcher.text)]
+        gaps = [b - a for a, b in zip(offsets, offsets[1:])]
+        assert all(half <= gap < interval + half for gap in gaps)
+        assert len(matcher.checkpoint_offsets) <= 1.5 * len(matcher.text) / interval
+
+    for _ in range(3000):
+        start = rng.randint(0, len(text))
+        text = text[:start] + "ab" + text[start:]
+        matcher.edit(text, start, start, start + 2)
+    check()
+    for _ in range(3000):
+        start = rng.randint(0, len(text) - 2)
+        text = text[:start] + text[start + 2:]
+        matcher.edit(text, start, start + 2, start)
+    check()
+    assert matcher.match_ends == IncrementalMatcher(program, text, interval=interval).match_ends
@@ -0,0 +1,123 @@
+import os
+import random
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from cursor import Cursor
+from program import Program
+import serialization
+from serialization import SerializationError
+from state import State, Transition, ConditionResult, MatchChar, AnyCharacter, collect_states
+
+
+def closure(states, cursor):
+    found = set(states)
+    stack = list(states)
+    while stack:
+        for transition in stack.pop().transition:
+            result = transition.condition.can_perform_transition(cursor)
+            if result.accepted and result.count == 0 and transition.end not in found:
+                found.add(transition.end)
+                stack.append(transition.end)
+    return found
+
+
+def reference_match(start, accept, string):
+    """Walks the state graph directly and returns the end of the longest match"""
+    cursor = Cursor(string)
+    current = closure({start}, cursor)
+    end = 0 if accept in current else None
+    for index in range(len(string)):
+        cursor.advance_to(index)
+        following = set()
+        for state in current:
+            for transition in state.transition:
+                result = transition.condition.can_perform_transition(cursor)
+                if result.accepted and result.count == 1:
+                    following.add(transition.end)
+        cursor.advance_to(index + 1)
+        current = closure(following, cursor)
+        if not current:
+            break
+        if accept in current:
+            end = index + 1
+    return end
+
+
+def random_graph(rng):
+    states = [State() for _ in range(rng.randint(1, 6))]
+    for state in states:
+        for _ in range(rng.randint(0, 3)):
+            end = rng.choice(states)
+            kind = rng.randrange(5)
+            if kind == 0:
+                state.transition.append(Transition.epsilon(end))
+            elif kind == 1:
+                state.transition.append(Transition.epsilon(end, lambda cursor: cursor.index % 2 == 0))
+            elif kind == 2:
+                state.transition.append(Transition(end, AnyCharacter(including_newline=False)))
+            else:
+                state.transition.append(Transition(end, MatchChar(rng.choice("ab"))))
+    return states[0], rng.choice(collect_states(states[0]))
+
+
+def random_string(rng):
+    return "".join(rng.choice("ab\n") for _ in range(rng.randint(0, 12)))
+
+
+def test_match_agrees_with_reference_walk():
+    rng = random.Random(0)
+    for _ in range(300):
+        start, accept = random_graph(rng)
+        program = Program(start, accept)
+        for _ in range(10):
+            string = random_string(rng)
+            assert program.match(string) == reference_match(start, accept, string)
+
+
+def test_match_agrees_with_reference_walk_across_threads():
+    rng = random.Random(1)
+    graphs = [random_graph(rng) for _ in range(20)]
+    programs = [Program(start, accept) for start, accept in graphs]
+    cases = [(i, random_string(rng)) for i in range(len(graphs)) for _ in range(20)]
+    expected = [reference_match(*graphs[i], string) for i, string in cases]
+
+    def run(_):
+        return [programs[i].match(string) for i, string in cases]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        for result in pool.map(run, range(32)):
+            assert result == expected
+
+
+def test_unreachable_accepting_state_is_rejected():
+    start, accept = State(), State()
+    with pytest.raises(ValueError):
+        Program(start, accept)
+
+
+class CaseInsensitiveChar(MatchChar):
+    def can_perform_transition(self, cursor):
+        if cursor.character is not None and cursor.character.lower() == self.char:
+            return ConditionResult.accepted_result()
+        return ConditionResult.rejected_result()
+
+
+def test_condition_subclasses_are_not_cached_or_serialized():
+    start, accept = State(), State()
+    start.transition.append(Transition(accept, CaseInsensitiveChar("a")))
+    program = Program(start, accept)
+
+    assert not program.is_cacheable
+    assert program.full_match("A")
+    with pytest.raises(SerializationError):
+        serialization.dumps(start, accept)
+
+
+def test_program_does_not_load_the_file_format():
+    code = "import sys, program; sys.exit('serialization' in sys.modules)"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    assert subprocess.run([sys.executable, "-c", code], cwd=root).returncode == 0
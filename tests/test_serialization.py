@@ -0,0 +1,238 @@
+import os
+import struct
+import sys
+
+import pytest
+
+import ASM
+import serialization
+from program import Program
+from serialization import SerializationError, HEADER, STATE_RECORD, TRANSITION_RECORD
+from state import State, Transition, MatchChar, AnyCharacter, collect_states
+
+
+def build_graph():
+    """(a|bc)*d, with an AnyCharacter loop after the accepting state"""
+    start, loop, b, accept = State(), State(), State(), State()
+    start.transition.append(Transition.epsilon(loop))
+    loop.transition.append(Transition(loop, MatchChar("a")))
+    loop.transition.append(Transition(b, MatchChar("b")))
+    b.transition.append(Transition(loop, MatchChar("c")))
+    loop.transition.append(Transition(accept, MatchChar("d")))
+    accept.transition.append(Transition(accept, AnyCharacter(including_newline=False)))
+    return start, accept
+
+
+def build_ast():
+    return ASM.AST(True, ASM.ImplicitGroup([
+        ASM.QuantifiedExpression(
+            ASM.Group([ASM.Alternation([ASM.MatchCharacter("a"), ASM.MatchString("bc")])], index=1),
+            ASM.Quantifier(ASM.QuantifierType.ZERO_OR_MORE, is_lazy=True),
+        ),
+        ASM.Anchor.endOfString,
+        ASM.Backreference(1),
+        ASM.CharacterGroup(True, [ASM.GroupItemCharacter("é"), ASM.GroupItemRange("a", "z")]),
+        ASM.AnyCharacter(),
+    ]))
+
+
+def describe(start):
+    """Returns the graph as (end index, condition repr) rows, in the order dumps() numbers the states"""
+    states = collect_states(start)
+    index_of = {state: i for i, state in enumerate(states)}
+    return [[(index_of[t.end], repr(t.condition)) for t in state.transition] for state in states]
+
+
+def test_round_trip(tmp_path):
+    start, accept = build_graph()
+    ast = build_ast()
+    path = tmp_path / "pattern.bin"
+    serialization.dump(str(path), start, accept, ast)
+
+    pattern = serialization.load(str(path))
+
+    rows = [[(end, repr(condition)) for end, condition in row] for row in pattern.transitions]
+    assert rows == describe(start)
+    assert (pattern.start, pattern.accept) == (0, 3)
+    assert pattern.ast.is_from_start_of_string
+    assert repr(pattern.ast.root) == repr(ast.root)
+
+    states = pattern.build_states()
+    assert describe(states[pattern.start]) == describe(start)
+
+
+def test_program_from_serialized_matches_like_the_graph():
+    start, accept = build_graph()
+    from_graph = Program(start, accept)
+    from_buffer = Program.from_serialized(serialization.loads(serialization.dumps(start, accept)))
+
+    for string in ["d", "abcad", "abd", "bcbcdxyz", "d\n", "", "x"]:
+        assert from_buffer.match(string) == from_graph.match(string)
+
+
+def test_round_trip_without_ast_or_accept():
+    start, _ = build_graph()
+    pattern = serialization.loads(serialization.dumps(start))
+    assert pattern.ast is None
+    assert pattern.accept is None
+    assert len(pattern.transitions) == 4
+
+
+def test_predicate_epsilon_is_rejected():
+    start, end = State(), State()
+    start.transition.append(Transition.epsilon(end, lambda cursor: True))
+    with pytest.raises(SerializationError):
+        serialization.dumps(start, end)
+
+
+def patched(data: bytes, offset: int, fmt: str, *values) -> bytes:
+    out = bytearray(data)
+    struct.pack_into(fmt, out, offset, *values)
+    return bytes(out)
+
+
+def valid_buffer() -> bytes:
+    start, accept = build_graph()
+    return serialization.dumps(start, accept, build_ast())
+
+
+TRANSITIONS_OFFSET = HEADER.size + 4 * STATE_RECORD.size
+
+
+@pytest.mark.parametrize("corrupt", [
+    lambda data: b"",
+    lambda data: data[:HEADER.size - 1],
+    lambda data: data[:len(data) - 1],
+    lambda data: b"XXXX" + data[4:],
+    lambda data: patched(data, 4, "<H", serialization.VERSION + 1),
+    # Start and accepting states out of range
+    lambda data: patched(data, 16, "<I", 4),
+    lambda data: patched(data, 20, "<I", 4),
+    # Transition to a state that doesn't exist
+    lambda data: patched(data, TRANSITIONS_OFFSET, "<I", 99),
+    # Unknown condition kind and invalid character code
+    lambda data: patched(data, TRANSITIONS_OFFSET + 4, "<B", 9),
+    lambda data: patched(data, TRANSITIONS_OFFSET + TRANSITION_RECORD.size + 5, "<I", 0x110000),
+    # Per-state transition counts adding up to more than the transition table
+    lambda data: patched(data, HEADER.size + 3 * STATE_RECORD.size + 4, "<I", 5),
+    lambda data: patched(data, HEADER.size + 4, "<I", 0),
+    # AST section: unknown anchor, unknown quantifier type, bad UTF-8, trailing bytes
+    lambda data: data.replace(b"\x07\x01\x06", b"\x07\x09\x06"),
+    lambda data: data.replace(b"\x09\x00\x01", b"\x09\x07\x01"),
+    lambda data: data.replace("é".encode("utf-8"), b"\xff\xff"),
+    lambda data: patched(data + b"\x00", 24, "<I", struct.unpack_from("<I", data, 24)[0] + 1),
+])
+def test_corrupt_file_raises_serialization_error(tmp_path, corrupt):
+    data = corrupt(valid_buffer())
+    assert data != valid_buffer()
+    path = tmp_path / "pattern.bin"
+    path.write_bytes(data)
+
+    with pytest.raises(SerializationError):
+        serialization.load(str(path))
+    with pytest.raises(SerializationError):
+        serialization.loads(data)
+
+
+@pytest.mark.parametrize("root", [
+    ASM.Group([], index=2 ** 31),
+    ASM.Group([], index=-2),
+    ASM.Backreference(2 ** 31),
+    ASM.MatchSet({"a", "b"}),
+])
+def test_unsupported_ast_raises_serialization_error(root):
+    start, accept = build_graph()
+    with pytest.raises(SerializationError):
+        serialization.dumps(start, accept, ASM.AST(False, root))
+
+
+def test_deep_ast_raises_serialization_error():
+    root = ASM.AnyCharacter()
+    for _ in range(sys.getrecursionlimit() + 10):
+        root = ASM.ImplicitGroup([root])
+    start, accept = build_graph()
+    with pytest.raises(SerializationError):
+        serialization.dumps(start, accept, ASM.AST(False, root))
+
+
+def library_patterns():
+    """A library holding the (a|bc)*d graph and single character patterns"""
+    start, accept = build_graph()
+    buffers = [serialization.dumps(start, accept, build_ast())]
+    for character in "xyz":
+        begin, end = State(), State()
+        begin.transition.append(Transition(end, MatchChar(character)))
+        buffers.append(serialization.dumps(begin, end))
+    return buffers
+
+
+def test_library_decodes_patterns_on_first_use(tmp_path):
+    path = tmp_path / "library.bin"
+    serialization.dump_library(str(path), library_patterns())
+
+    with serialization.open_library(str(path)) as library:
+        assert len(library) == 4
+        assert repr(library) == "<PatternLibrary patterns=4 decoded=0>"
+
+        y = Program.from_serialized(library[2])
+        assert y.full_match("y") and not y.full_match("x")
+        assert repr(library) == "<PatternLibrary patterns=4 decoded=1>"
+        assert library[2] is library[2]
+        assert library[-2] is library[2]
+
+        first = library[0]
+        assert repr(first.ast.root) == repr(build_ast().root)
+        assert Program.from_serialized(first).full_match("abcad")
+
+        with pytest.raises(IndexError):
+            library[4]
+
+
+def test_corrupt_library_pattern_raises_on_use_and_still_closes(tmp_path):
+    buffers = library_patterns()
+    buffers[1] = buffers[1][:len(buffers[1]) - 1]
+    path = tmp_path / "library.bin"
+    path.write_bytes(serialization.dumps_library(buffers))
+
+    library = serialization.open_library(str(path))
+    assert Program.from_serialized(library[2]).full_match("y")
+    with pytest.raises(SerializationError):
+        library[1]
+    library.close()
+
+
+@pytest.mark.parametrize("corrupt", [
+    lambda data: b"",
+    lambda data: data[:8],
+    lambda data: b"XXXX" + data[4:],
+    lambda data: patched(data, 4, "<H", serialization.VERSION + 1),
+    lambda data: patched(data, 8, "<I", 1000),
+])
+def test_corrupt_library_header_raises_serialization_error(tmp_path, corrupt):
+    path = tmp_path / "library.bin"
+    path.write_bytes(corrupt(serialization.dumps_library(library_patterns())))
+    with pytest.raises(SerializationError):
+        serialization.open_library(str(path))
+
+
+def test_corrupt_library_entry_raises_serialization_error():
+    data = serialization.dumps_library(library_patterns())
+    library = serialization.PatternLibrary(patched(data, serialization.LIBRARY_HEADER.size, "<Q", len(data)))
+    with pytest.raises(SerializationError):
+        library[0]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_library_is_usable_from_forked_children(tmp_path):
+    path = tmp_path / "library.bin"
+    serialization.dump_library(str(path), library_patterns())
+
+    with serialization.open_library(str(path)) as library:
+        children = []
+        for i, string in enumerate(["abcd", "x", "y", "z"]):
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0 if Program.from_serialized(library[i]).full_match(string) else 1)
+            children.append(pid)
+        for pid in children:
+            assert os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) == 0